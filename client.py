@@ -3,19 +3,35 @@ Class that is responsible for HTTP communications with a FHIR server
 """
 
 import logging
-import json
-from collections import defaultdict
+import tempfile
+from itertools import islice
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed,
+    wait
+)
 from pprint import pformat
 
+import ijson
+import orjson
 import requests
 import urllib.parse
 
-from utils import requests_retry_session, check_service_status
-from config import FHIR_VERSION
+from utils import (
+    requests_retry_session, check_service_status, load_resource_dict
+)
+from config import FHIR_VERSION, DEFAULT_MAX_WORKERS
 
 logging.getLogger(
     requests.packages.urllib3.__package__).setLevel(logging.WARNING)
 
+# Response status codes that indicate success for each request method
+_SUCCESS_STATUS = {
+    'GET': frozenset({200}),
+    'POST': frozenset({200, 201}),
+    'PUT': frozenset({200, 201}),
+    'DELETE': frozenset({204, 200}),
+}
+
 
 class FhirApiClient(object):
 
@@ -26,14 +42,50 @@ class FhirApiClient(object):
         self.status_endpoint = status_endpoint
         self.auth = auth
         self.fhir_version = fhir_version
+        # Maps GET request url to (ETag, (success, result)) of last response
+        self._etag_cache = {}
         self.session = requests_retry_session()
 
-    def post_or_put_all(self, resource_dicts, endpoint=None, method='post'):
+    @property
+    def fhir_version(self):
+        return self._fhir_version
+
+    @fhir_version.setter
+    def fhir_version(self, fhir_version):
+        """
+        Set the FHIR version and rebuild the default request headers that
+        depend on it
+        """
+        self._fhir_version = fhir_version
+        self._default_headers = self._fhir_version_headers()
+
+    @property
+    def session(self):
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        """
+        Set the requests.Session and rebuild the table of its bound request
+        methods used by send_request
+        """
+        self._session = session
+        self._dispatch = {
+            name: getattr(session, name)
+            for name in ('get', 'post', 'put', 'delete', 'patch', 'head',
+                         'options')
+        }
+
+    def post_or_put_all(self, resource_dicts, endpoint=None, method='post',
+                        max_workers=DEFAULT_MAX_WORKERS):
         """
         POST/PUT all FHIR resources to server. Send requests to endpoint if its
         provided, otherwise, get endpoint for each resource from its resource
         dict in resource_dicts
 
+        Requests are sent concurrently by a pool of max_workers threads which
+        share this client's session
+
         Returns result dict containing successes and error results:
 
             {
@@ -51,6 +103,8 @@ class FhirApiClient(object):
         :type resource_dicts: list of dicts
         :param endpoint: Optional FHIR endpoint to use for all requests
         :type endpoint: str
+        :param max_workers: max number of requests to send concurrently
+        :type max_workers: int
         :param auth: basic auth parameters
         :type auth: requests.auth.HTTPBasicAuth object
 
@@ -58,18 +112,102 @@ class FhirApiClient(object):
         for details.
         """
         success = True
-        results = defaultdict(dict)
+        results = {'success': {}, 'errors': {}}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self.post_or_put, rd.get('endpoint', endpoint), rd,
+                    method=method
+                ): rd['filepath']
+                for rd in resource_dicts
+            }
+            for future in as_completed(futures):
+                filepath = futures[future]
+                success_one, result = future.result()
+                success = success_one & success
+
+                key = 'success' if success_one else 'errors'
+                results[key][filepath] = result
+
+        return success, results
+
+    def post_or_put_files(self, filepaths, endpoint=None, method='post',
+                          max_workers=DEFAULT_MAX_WORKERS,
+                          max_processes=None):
+        """
+        Load FHIR resources from JSON files and POST/PUT them to server.
+
+        Files are parsed by a pool of max_processes worker processes and each
+        resource is sent by a pool of max_workers threads as soon as it has
+        been loaded, so parsing and sending overlap. At most 2 * max_workers
+        files are being loaded or sent at any time, so memory use does not
+        grow with the number of files.
 
-        for rd in resource_dicts:
-            filepath = rd['filepath']
-            ep = rd.get('endpoint', endpoint)
-            success_one, result = self.post_or_put(ep, rd, method=method)
-            success = success_one & success
+        Files which cannot be loaded are reported in the errors of the
+        result dict.
+
+        :param filepaths: paths to FHIR resource JSON files
+        :type filepaths: iterable of str
+        :param endpoint: Optional FHIR endpoint to use for all requests
+        :type endpoint: str
+        :param max_workers: max number of requests to send concurrently
+        :type max_workers: int
+        :param max_processes: max number of processes loading files. Defaults
+        to the number of CPUs on the machine
+        :type max_processes: int
 
-            if success_one:
-                results['success'][filepath] = result
-            else:
-                results['errors'][filepath] = result
+        :returns: a tuple (success boolean, result dict) See post_or_put_all
+        for details.
+        """
+        success = True
+        results = {'success': {}, 'errors': {}}
+        filepaths = iter(filepaths)
+
+        with ProcessPoolExecutor(max_workers=max_processes) as loaders, \
+                ThreadPoolExecutor(max_workers=max_workers) as senders:
+            # Maps each in flight future to (is load future, filepath)
+            pending = {
+                loaders.submit(load_resource_dict, fp): (True, fp)
+                for fp in islice(filepaths, 2 * max_workers)
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    is_load, filepath = pending.pop(future)
+
+                    # Hand loaded resource over to the senders
+                    if is_load:
+                        try:
+                            rd = future.result()
+                        except Exception as e:
+                            self.logger.error(
+                                'Could not load %s: %s', filepath, e
+                            )
+                            success = False
+                            results['errors'][filepath] = {
+                                'status_code': None,
+                                'request_url': None,
+                                'response': str(e)
+                            }
+                        else:
+                            send = senders.submit(
+                                self.post_or_put, rd.get('endpoint', endpoint),
+                                rd, method=method
+                            )
+                            pending[send] = (False, filepath)
+                            continue
+                    else:
+                        success_one, result = future.result()
+                        success = success_one & success
+
+                        key = 'success' if success_one else 'errors'
+                        results[key][filepath] = result
+
+                    # Start loading the next file once one has finished
+                    for fp in islice(filepaths, 1):
+                        load = loaders.submit(load_resource_dict, fp)
+                        pending[load] = (True, fp)
 
         return success, results
 
@@ -101,37 +239,126 @@ class FhirApiClient(object):
         resource = resource_dict['content']
         resource_type = resource_dict['resource_type']
 
+        method_name = method.upper()
         self.logger.info(
-            f'{method.upper()}ing FHIR {resource_type} from {filename}'
+            '%sing FHIR %s from %s', method_name, resource_type, filename
         )
 
         # Send post
         request_kwargs = {}
-        request_kwargs['json'] = resource
+        request_kwargs['data'] = orjson.dumps(resource)
+        request_kwargs['headers'] = self._json_body_headers()
         success, result = self.send_request(
             method, endpoint, **request_kwargs
         )
 
         if success:
             self.logger.info(
-                f'✅ {method.upper()} {filename} to {endpoint} succeeded'
+                '✅ %s %s to %s succeeded', method_name, filename, endpoint
             )
         else:
             self.logger.info(
-                f'❌ {method.upper()} {filename} to {endpoint} failed'
+                '❌ %s %s to %s failed', method_name, filename, endpoint
             )
 
         return success, result
 
-    def delete_all(self, endpoint, **request_kwargs):
+    def post_or_put_bundle(self, resource_dicts, endpoint=None, method='post',
+                           bundle_type='batch', chunk_size=200):
+        """
+        POST/PUT all FHIR resources to server inside of FHIR Bundles. Each
+        Bundle holds up to chunk_size resources and is sent to the server's
+        base URL in a single request.
+
+        Each Bundle is serialized one entry at a time into a temporary file
+        which is uploaded as the request body, so the serialized Bundle is
+        never held in memory as a whole. The file is rewound if the request
+        is retried.
+
+        Returns a tuple (success boolean, result dict) where the result dict
+        has the same form as the one returned by post_or_put_all. The result
+        for each resource is built from its entry in the response Bundle.
+
+        :param resource_dicts: resource content and metadata
+        :type resource_dicts: iterable of dicts
+        :param endpoint: Optional FHIR endpoint to use for resources whose
+        resource dict does not have one
+        :type endpoint: str
+        :param method: HTTP method to use for each resource in the Bundle
+        :type method: str
+        :param bundle_type: FHIR Bundle type, either batch or transaction
+        :type bundle_type: str
+        :param chunk_size: max number of resources to send in one Bundle
+        :type chunk_size: int
+
+        :returns: a tuple (success boolean, result dict) See post_or_put_all
+        for details.
+        """
+        success = True
+        results = {'success': {}, 'errors': {}}
+
+        resource_dicts = iter(resource_dicts)
+        while True:
+            chunk = list(islice(resource_dicts, chunk_size))
+            if not chunk:
+                break
+            self.logger.info(
+                '%sing %s FHIR resources in a %s Bundle',
+                method.upper(), len(chunk), bundle_type
+            )
+            with tempfile.TemporaryFile() as body:
+                body.writelines(
+                    self._iter_bundle_bytes(
+                        chunk, method, bundle_type, endpoint=endpoint
+                    )
+                )
+                body.seek(0)
+                success_bundle, result = self.send_request(
+                    'post', self.base_url, data=body,
+                    headers=self._json_body_headers()
+                )
+
+            # Bundle was rejected as a whole
+            if not success_bundle:
+                success = False
+                for rd in chunk:
+                    results['errors'][rd['filepath']] = result
+                continue
+
+            entries = result['response'].get('entry', [])
+            for rd, entry in zip(chunk, entries):
+                success_one, result_one = self._bundle_entry_result(
+                    entry, method
+                )
+                success = success_one & success
+
+                key = 'success' if success_one else 'errors'
+                results[key][rd['filepath']] = result_one
+
+            # Resources without an entry in the response Bundle
+            for rd in chunk[len(entries):]:
+                success = False
+                results['errors'][rd['filepath']] = result
+
+        return success, results
+
+    def delete_all(self, endpoint, max_workers=DEFAULT_MAX_WORKERS,
+                   stream=False, **request_kwargs):
         """
         Delete FHIR resources at endpoint on FHIR server.
 
             - Send GET request to endpoint
-            - For each valid result, send DELETE request
+            - For each valid result, send DELETE request. DELETE requests are
+            sent concurrently by a pool of max_workers threads
 
         :param endpoint: FHIR endpoint
         :type endpoint: str
+        :param max_workers: max number of requests to send concurrently
+        :type max_workers: int
+        :param stream: whether to parse the entries of the search Bundle
+        incrementally as they are downloaded rather than loading the whole
+        Bundle into memory. Use for searches that return many resources.
+        :type stream: bool
         :param request_kwargs: optional request keyword args
         :type request_kwargs: key, value pairs
         :returns: a boolean indicating whether all items at endpoint were
@@ -148,33 +375,61 @@ class FhirApiClient(object):
         success, result = self.send_request(
             'get',
             endpoint,
+            stream=stream,
             **request_kwargs
         )
         resp_content = result['response']
         request_url = result['request_url']
-        self.logger.debug(
-            f'Fetched {resp_content.get("total")} item(s) from {request_url}'
-        )
+
+        if stream and success:
+            # Bundle entries are parsed one at a time from the response body
+            resp_content.raw.decode_content = True
+            entries = ijson.items(resp_content.raw, 'entry.item')
+            self.logger.debug('Streaming item(s) from %s', request_url)
+        else:
+            self.logger.debug(
+                'Fetched %s item(s) from %s',
+                resp_content.get('total'), request_url
+            )
+            entries = resp_content.get('entry', [])
 
         if not success:
             return False
 
         # Delete individual resources
-        for entry in resp_content.get('entry', []):
-            if entry['resource'].get('resourceType') == 'OperationOutcome':
-                continue
-            rs = entry['resource']
-            url = f'{self.base_url}/{rs["resourceType"]}/{rs["id"]}'
-            self.logger.debug(f'Deleting {url}')
-
-            success_delete, result = self.send_request(
-                'delete', url, auth=request_kwargs.get('auth')
-            )
-            success = success_delete & success
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(
+                        self.send_request, 'delete', url,
+                        auth=request_kwargs.get('auth')
+                    )
+                    for url in self._resource_urls(entries)
+                ]
+                for future in as_completed(futures):
+                    success_delete, result = future.result()
+                    success = success_delete & success
+        finally:
+            if stream:
+                resp_content.close()
 
         return success
 
-    def send_request(self, request_method_name, url, **request_kwargs):
+    def _resource_urls(self, entries):
+        """
+        Generate the URL of each resource in a list of FHIR Bundle entries,
+        skipping any OperationOutcomes
+        """
+        for entry in entries:
+            rs = entry['resource']
+            if rs.get('resourceType') == 'OperationOutcome':
+                continue
+            url = f'{self.base_url}/{rs["resourceType"]}/{rs["id"]}'
+            self.logger.debug('Deleting %s', url)
+            yield url
+
+    def send_request(self, request_method_name, url, stream=False,
+                     use_cache=False, **request_kwargs):
         """
         Send request to the FHIR validation server. Return a tuple
         (success boolean, result dict).
@@ -190,10 +445,20 @@ class FhirApiClient(object):
                 'response': response.json() or response.text
             }
 
+        If stream is True and the request is successful, the response body is
+        not read and the result dict's response is the requests.Response
+        object itself. The caller is then responsible for closing it.
+
         :param request_method_name: requests method name
         :type request_method_name: str
         :param url: FHIR url
         :type url: str
+        :param stream: whether to defer downloading the response body
+        :type stream: bool
+        :param use_cache: whether to send a conditional GET using the ETag of
+        the last response from the same url, and return the cached result of
+        that response if the server replies 304 Not Modified
+        :type use_cache: bool
         :param request_kwargs: optional request keyword args
         :type request_kwargs: key, value pairs
         :returns: tuple of the form
@@ -207,49 +472,92 @@ class FhirApiClient(object):
 
         headers = request_kwargs.get('headers', {})
         if 'Content-Type' not in headers:
-            headers.update(self._fhir_version_headers())
+            headers.update(self._default_headers)
         request_kwargs['headers'] = headers
 
+        # Serialize JSON body here rather than letting requests do it, so that
+        # only the FHIR Content-Type header is sent
+        body = request_kwargs.pop('json', None)
+        if body is not None:
+            request_kwargs['data'] = orjson.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+
+        # Make GET conditional on the ETag of the last response
+        use_cache = (
+            use_cache and not stream and request_method_name.lower() == 'get'
+        )
+        if use_cache:
+            prepared = requests.PreparedRequest()
+            prepared.prepare_url(url, request_kwargs.get('params'))
+            cache_key = prepared.url
+            cached = self._etag_cache.get(cache_key)
+            if cached:
+                headers['If-None-Match'] = cached[0]
+
         # Send request
-        request_method = getattr(self.session,
-                                 request_method_name.lower())
-        response = request_method(url, **request_kwargs)
-        resp_content = self._response_content(response)
+        request_method = (
+            self._dispatch.get(request_method_name.lower()) or
+            getattr(self.session, request_method_name.lower())
+        )
+        response = request_method(url, stream=stream, **request_kwargs)
+
+        if (use_cache and cached and
+                response.status_code == requests.codes.not_modified):
+            self.logger.debug('Using cached response for %s', cache_key)
+            return cached[1]
 
         # Determine success and log result
-        request_method_name = request_method_name.upper()
+        method_name = request_method_name.upper()
         request_url = urllib.parse.unquote(response.url)
+        ok_status = (
+            response.status_code in
+            _SUCCESS_STATUS.get(method_name, ())
+        )
+        # Only build debug messages if they will actually be logged
+        debug = self.logger.isEnabledFor(logging.DEBUG)
 
-        success_status = {
-            'GET': {200},
-            'POST': {200, 201},
-            'PUT': {200, 201},
-            'DELETE': {204, 200},
-        }
-
-        if response.status_code in success_status.get(request_method_name, {}):
-            errors = self._errors_from_response(resp_content)
-            if not errors:
-                success = True
+        # Leave body of successful streamed response for the caller to read
+        if stream and ok_status:
+            if debug:
                 self.logger.debug(
-                    f'{request_method_name} {request_url} succeeded. '
-                    f'Response:\n{pformat(resp_content)}'
+                    '%s %s succeeded. Streaming response',
+                    method_name, request_url
                 )
-            else:
+            return True, {'status_code': response.status_code,
+                          'request_url': request_url,
+                          'response': response}
+
+        resp_content = self._response_content(response)
+
+        if ok_status:
+            if not self._has_error(resp_content):
+                success = True
+                if debug:
+                    self.logger.debug(
+                        '%s %s succeeded. Response:\n%s',
+                        method_name, request_url, pformat(resp_content)
+                    )
+            elif debug:
                 self.logger.debug(
-                    f'{request_method_name} {request_url} failed. '
-                    f'Caused by:\n{pformat(resp_content)}'
+                    '%s %s failed. Caused by:\n%s',
+                    method_name, request_url, pformat(resp_content)
                 )
-        else:
+        elif debug:
             self.logger.debug(
-                f'{request_method_name} {request_url} failed, '
-                f'status {response.status_code}. '
-                f'Caused by:\n{pformat(resp_content)}'
+                '%s %s failed, status %s. Caused by:\n%s',
+                method_name, request_url, response.status_code,
+                pformat(resp_content)
             )
 
-        return success, {'status_code': response.status_code,
-                         'request_url': request_url,
-                         'response': resp_content}
+        result = {'status_code': response.status_code,
+                  'request_url': request_url,
+                  'response': resp_content}
+
+        etag = response.headers.get('ETag')
+        if use_cache and success and etag:
+            self._etag_cache[cache_key] = (etag, (success, result))
+
+        return success, result
 
     def check_service_status(self, exit_on_down=False, log_msg=None):
         """
@@ -258,7 +566,7 @@ class FhirApiClient(object):
         """
         down = check_service_status(self.status_endpoint or self.base_url,
                                     auth=self.auth,
-                                    headers=self._fhir_version_headers())
+                                    headers=self._default_headers)
         if down:
             self.logger.error(log_msg)
             if exit_on_down:
@@ -281,14 +589,88 @@ class FhirApiClient(object):
             f'application/fhir+json; fhirVersion={major_version}.0'
         }
 
+    def _iter_bundle_bytes(self, resource_dicts, method, bundle_type,
+                           endpoint=None):
+        """
+        Generate the serialized JSON of a FHIR Bundle containing an entry for
+        each resource dict, one entry at a time
+
+        :returns: generator of bytes
+        """
+        yield (
+            b'{"resourceType":"Bundle","type":' + orjson.dumps(bundle_type) +
+            b',"entry":['
+        )
+        for i, rd in enumerate(resource_dicts):
+            entry = orjson.dumps(
+                self._bundle_entry(rd, method, endpoint=endpoint)
+            )
+            yield b',' + entry if i else entry
+        yield b']}'
+
+    def _bundle_entry(self, resource_dict, method, endpoint=None):
+        """
+        Build a FHIR Bundle entry for a resource dict. The entry's request url
+        is relative to the server's base URL as required by the FHIR spec.
+        endpoint is used if the resource dict does not have one.
+
+        :returns: a dict containing the Bundle entry
+        """
+        resource = resource_dict['content']
+        url = resource_dict.get('endpoint', endpoint)
+        if url:
+            if url.startswith(self.base_url):
+                url = url[len(self.base_url):]
+            url = url.lstrip('/')
+        else:
+            url = resource_dict['resource_type']
+            if method.upper() == 'PUT':
+                url = f'{url}/{resource["id"]}'
+
+        return {
+            'resource': resource,
+            'request': {'method': method.upper(), 'url': url}
+        }
+
+    def _bundle_entry_result(self, entry, method):
+        """
+        Determine success of a single entry in a FHIR Bundle response and
+        build a result dict like the one returned by send_request
+
+        :returns: a tuple (success boolean, result dict)
+        """
+        response = entry.get('response', {})
+        status = (response.get('status') or '').split(' ', 1)[0]
+        status_code = int(status) if status.isdigit() else 0
+        content = response.get('outcome') or entry.get('resource') or {}
+        success = (
+            status_code in _SUCCESS_STATUS.get(method.upper(), ()) and
+            not self._has_error(content)
+        )
+        return success, {'status_code': status_code,
+                         'request_url': response.get('location'),
+                         'response': content}
+
+    def _json_body_headers(self):
+        """
+        Generate the request headers for a JSON body serialized by this
+        client. Falls back to a plain JSON Content-Type if there is no FHIR
+        version to build the FHIR Content-Type from.
+
+        :returns: a dict containing request headers
+        """
+        headers = dict(self._default_headers)
+        headers.setdefault('Content-Type', 'application/json')
+        return headers
+
     def _response_content(self, response):
         """
         Try to parse response body as JSON, otherwise return the
         text version of body
         """
         try:
-            resp_content = response.json()
-        except json.decoder.JSONDecodeError:
+            resp_content = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             resp_content = response.text
         return resp_content
 
@@ -298,4 +680,13 @@ class FhirApiClient(object):
         """
         response_body = response_body or {}
         return [issue for issue in response_body.get('issue', [])
-                if issue['severity'] == 'error']
+                if issue.get('severity') == 'error']
+
+    def _has_error(self, response_body):
+        """
+        Check whether any of the issues in FHIR response are marked error.
+        Stops at the first error found.
+        """
+        response_body = response_body or {}
+        return any(issue.get('severity') == 'error'
+                   for issue in response_body.get('issue', ()))
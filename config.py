@@ -1,7 +1,12 @@
 import logging
 import os
+from functools import lru_cache
 
+# DSTU2 is FHIR version 1.0.2, earlier versions are grouped with it
+_FHIR_NAME_BY_MAJOR = {0: 'dstu2', 1: 'dstu2', 2: 'dstu2', 3: 'stu3', 4: 'r4'}
 
+
+@lru_cache(maxsize=8)
 def fhir_version_name(fhir_version):
     """
     Get the name of a particular FHIR version number
@@ -10,24 +15,24 @@ def fhir_version_name(fhir_version):
     :type: str
 
     :returns: str
+    :raises: ValueError if no name exists for the FHIR version
     """
-    major_version = int(fhir_version.split('.')[0])
-
-    if major_version < 3:
-        return 'dstu2'
-    elif (major_version >= 3) and (major_version < 4):
-        return 'stu3'
-    elif (major_version >= 4) and (major_version < 5):
-        return 'r4'
-    else:
-        raise Exception(
+    major_version = int(fhir_version.partition('.')[0])
+
+    try:
+        return _FHIR_NAME_BY_MAJOR[major_version]
+    except KeyError:
+        raise ValueError(
             f'Invalid fhir version supplied: {fhir_version}! No name exists '
             'for the supplied fhir version.'
-        )
+        ) from None
 
 
 DEFAULT_LOG_LEVEL = logging.DEBUG
 
+# Max number of concurrent requests sent by FhirApiClient bulk operations
+DEFAULT_MAX_WORKERS = 8
+
 FHIR_VERSION = '4.0.0'
 FHIR_VERSION_NAME = fhir_version_name(FHIR_VERSION)
 CONFORMANCE_RESOURCES = {
@@ -1,17 +1,37 @@
 import datetime
+import inspect
 import json
 import logging
 import os
+import socket
 import time
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
 from requests.packages.urllib3.util.retry import Retry
 
 from config import DEFAULT_LOG_LEVEL
 
 logger = logging.getLogger(__name__)
 
+# HTTP methods which may be retried by requests_retry_session
+RETRY_METHODS = frozenset(
+    ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS']
+)
+
+# urllib3 defaults (which already disable Nagle's algorithm) plus TCP
+# keepalive so idle pooled connections are not dropped by intermediaries
+SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+# Keepalive probe timing options are not available on all platforms
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+if hasattr(socket, 'TCP_KEEPINTVL'):
+    SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10))
+
 
 def setup_logger(log_level=DEFAULT_LOG_LEVEL):
     """
@@ -68,14 +88,18 @@ def read_json(filepath, default=None):
     if (default is not None) and (not os.path.isfile(filepath)):
         return default
 
-    with open(filepath, 'r') as data_file:
-        return json.load(data_file)
+    with open(filepath, 'rb') as data_file:
+        return orjson.loads(data_file.read())
 
 
 def write_json(data, filepath, **kwargs):
     r"""
     Write Python dict to JSON file.
 
+    Data is serialized with orjson which only supports an indent of 2, so any
+    non-zero indent is written as 2. If keyword arguments other than indent
+    and sort_keys are given, json.dump is used instead.
+
     :param data: your data
     :type data: dict
     :param filepath: where to write your JSON file
@@ -86,13 +110,56 @@ def write_json(data, filepath, **kwargs):
         kwargs['indent'] = 4
     if 'sort_keys' not in kwargs:
         kwargs['sort_keys'] = True
-    with open(filepath, 'w') as json_file:
-        json.dump(data, json_file, **kwargs)
+
+    if set(kwargs) - {'indent', 'sort_keys'}:
+        with open(filepath, 'w') as json_file:
+            json.dump(data, json_file, **kwargs)
+        return
+
+    # json.dump coerces non-str keys to strings, orjson only does if asked
+    option = orjson.OPT_NON_STR_KEYS
+    if kwargs['indent']:
+        option |= orjson.OPT_INDENT_2
+    if kwargs['sort_keys']:
+        option |= orjson.OPT_SORT_KEYS
+    with open(filepath, 'wb') as json_file:
+        json_file.write(orjson.dumps(data, option=option))
+
+
+def load_resource_dict(filepath):
+    """
+    Read a FHIR resource JSON file into the resource dict expected by
+    FhirApiClient.post_or_put
+
+    :param filepath: path to FHIR resource JSON file
+    :type filepath: str
+    :return: resource content and metadata
+    :rtype: dict
+    """
+    content = read_json(filepath)
+    return {
+        'content': content,
+        'content_type': 'json',
+        'resource_type': content.get('resourceType'),
+        'filename': os.path.basename(filepath),
+        'filepath': filepath
+    }
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connections are created with SOCKET_OPTIONS
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
 
 
 def requests_retry_session(
         session=None, total=10, read=10, connect=1, status=10,
-        backoff_factor=5, status_forcelist=(500, 502, 503, 504)
+        backoff_factor=5, status_forcelist=(500, 502, 503, 504),
+        backoff_max=30, pool_size=32
 ):
     """
     Send an http request and retry on failures or redirects
@@ -107,34 +174,76 @@ def requests_retry_session(
     :param status: total retries on bad status codes defined in
     `status_forcelist`
     :param backoff_factor: affects sleep time between retries
+    :param backoff_max: max sleep time in seconds between retries. Only
+    applied with urllib3 >= 2, older versions always cap it at 120
     :param status_forcelist: list of HTTP status codes that force retry
+    :param pool_size: max number of connections to keep alive in the
+    connection pool. Should be at least the number of threads sharing the
+    session (i.e. the max_workers of FhirApiClient bulk operations),
+    otherwise extra connections are opened and then discarded after use
     """
     session = session or requests.Session()
+    session.headers['Connection'] = 'keep-alive'
 
-    retry = Retry(
-        total=total,
-        read=read,
-        connect=connect,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-        method_whitelist=False
-    )
-    adapter = HTTPAdapter(max_retries=retry)
+    retry_kwargs = {
+        'total': total,
+        'read': read,
+        'connect': connect,
+        'status': status,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': status_forcelist,
+        'respect_retry_after_header': True,
+        'raise_on_status': False,
+    }
+    # urllib3 1.26 renamed method_whitelist to allowed_methods and 2.0
+    # removed the old name and added backoff_max
+    retry_params = inspect.signature(Retry).parameters
+    if 'allowed_methods' in retry_params:
+        retry_kwargs['allowed_methods'] = RETRY_METHODS
+    else:
+        retry_kwargs['method_whitelist'] = RETRY_METHODS
+    if 'backoff_max' in retry_params:
+        retry_kwargs['backoff_max'] = backoff_max
+
+    retry = Retry(**retry_kwargs)
+    adapter = KeepAliveAdapter(max_retries=retry,
+                               pool_connections=pool_size,
+                               pool_maxsize=pool_size, pool_block=False)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
 
     return session
 
 
-def check_service_status(url, exit_on_down=False, **request_kwargs):
+# Shared session for status checks made without a caller supplied session
+_HEALTH_SESSION = requests_retry_session(total=1, connect=1)
+# ETags of the last successful status check of each url
+_STATUS_ETAGS = {}
+
+
+def check_service_status(url, exit_on_down=False, session=None,
+                         **request_kwargs):
     """
     Check service status and optionally exit program if server returns
     non-200 status code
+
+    :param session: the requests.Session to send the request with. Defaults
+    to a module level session shared by all status checks, which only
+    retries once so that a down service is reported promptly
+
+    If a previous check of url returned an ETag, the request is made
+    conditional on it so that an unchanged service answers with an empty
+    304 Not Modified response, which counts as up.
     """
     # Check service
+    session = session or _HEALTH_SESSION
+    etag = _STATUS_ETAGS.get(url)
+    if etag:
+        headers = dict(request_kwargs.get('headers') or {})
+        headers['If-None-Match'] = etag
+        request_kwargs['headers'] = headers
     try:
-        response = requests_retry_session(total=1,
-                                          connect=1).get(url, **request_kwargs)
+        response = session.get(url, **request_kwargs)
     # Service is not up
     except requests.exceptions.ConnectionError:
         logger.error(
@@ -143,7 +252,12 @@ def check_service_status(url, exit_on_down=False, **request_kwargs):
         is_down = True
     else:
         # Service is up but did not return 200 status code
-        is_down = response.status_code >= 300
+        is_down = (
+            response.status_code >= 300 and
+            response.status_code != requests.codes.not_modified
+        )
+        if not is_down and response.headers.get('ETag'):
+            _STATUS_ETAGS[url] = response.headers['ETag']
         if is_down:
             logger.warning(
                 f'Service {url} is up but returned non 200 status. Caused by '